@@ -1,142 +1,544 @@
-#!/usr/bin/env python
+#!/usr/bin/env python3
 # -*- coding: utf-8 -*-
 
-import urllib
+import asyncio
+import contextlib
+import ctypes
+import functools
+import hashlib
+import os
+import urllib.parse
 import subprocess
-import time
 import re
+import secrets
+import select
+import shutil
 import platform
 import argparse
+import time
+
+try:
+    import pyperclip
+except ImportError:
+    pyperclip = None
+
+try:
+    from AppKit import NSPasteboard
+except ImportError:
+    NSPasteboard = None
+
+try:
+    from Xlib import X
+    from Xlib import display as xdisplay
+    from Xlib.ext import xfixes
+except ImportError:
+    xdisplay = None
 
 
 # Constants
 CONNECTED_DEVICES_DELAY_DEFAULT = 5
 NO_CONNECTED_DEVICE_DELAY_DEFAULT = 60
+# no backoff by default, copies on a device are only noticed by syncing
+MAX_DELAY_DEFAULT = CONNECTED_DEVICES_DELAY_DEFAULT
+DEBOUNCE_MS_DEFAULT = 250
+# interval in seconds to check the cheap clipboard change counters
+CLIPBOARD_CHANGE_COUNT_POLL_INTERVAL = 0.2
+# longer clipboard texts are shortened in the status output
+PRINTED_CLIPBOARD_MAX_LENGTH = 50
+CLIPBOARD_BACKENDS = ['auto', 'native', 'pyperclip']
+CLIPBOARD_BACKEND_DEFAULT = 'auto'
+# seconds to wait for the owner of the X clipboard to hand it over
+X_SELECTION_TIMEOUT = 1
+# followed by a random nonce per command, so that no output of a command
+# like a clipboard containing the marker can end it early
+ADB_SHELL_END_MARKER = b"__ADBCLIPBOARD_END_"
+ADB_CLIPBOARD_READ_COMMAND = \
+    b"am broadcast -n ch.pete.adbclipboard/.ReadReceiver"
+# followed by the URL encoded text
+ADB_CLIPBOARD_WRITE_COMMAND = \
+    b"am broadcast -n ch.pete.adbclipboard/.WriteReceiver -e text "
+# maximum size of a buffered response, must hold the largest clipboard
+ADB_STREAM_LIMIT = 8 * 1024 * 1024
+ADB_SERVER_HOST = "127.0.0.1"
+# the adb client and server use the same variable to change the port
+ADB_SERVER_PORT = int(os.environ.get('ANDROID_ADB_SERVER_PORT', 5037))
+ADB_TRACK_DEVICES_RETRY_DELAY = 5
+# seconds after which a hanging adb operation is given up
+ADB_DEVICES_TIMEOUT = 3
+ADB_SHELL_TIMEOUT = 5
+RESPONSE_RESULT_PREFIX = b"result="
+# result of am broadcast when no receiver handled it, i.e. AdbClipboard is
+# not installed. The app itself answers -1 or its own codes like 2 for an
+# empty clipboard.
+RESPONSE_STATUS_NOT_RECEIVED = 0
+RESPONSE_DATA_PREFIX = b"data=\""
+# characters that urlEncode() does not change, all of them are safe in the
+# shell of the device. Not ~ that the shell expands to a directory.
+NEEDS_URL_ENCODING_PATTERN = re.compile(r"[^A-Za-z0-9_.\-]")
 
 verbose = False
 connectedDevicesDelay = CONNECTED_DEVICES_DELAY_DEFAULT
 noConnectedDeviceDelay = NO_CONNECTED_DEVICE_DELAY_DEFAULT
-
-
-def parseArgs():
+maxDelay = MAX_DELAY_DEFAULT
+debounceMs = DEBOUNCE_MS_DEFAULT
+clipboardBackend = CLIPBOARD_BACKEND_DEFAULT
+# device hashes pushed by the adb server, None while not tracking
+trackedDeviceHashes = None
+# set when the device list or the clipboard of this computer changed, wakes
+# up the sync
+syncRequested = None
+
+
+def parseArgs(argv=None):
+    # argv defaults to the arguments of the command line
     parser = argparse.ArgumentParser(
         description='Sync clipboard with connected Android devices.')
     parser.add_argument('-v', '--verbose', action='store_true',
                         help='Output status on the console')
     parser.add_argument('-c', '--connected-devices-delay', type=int,
                         help="Delay in seconds between each sync if there is" +
-                        " at least one device connected." +
+                        " at least one device connected, the delay grows" +
+                        " up to the maximum delay while nothing changes." +
                         " Defaults to {0} seconds."
                         .format(CONNECTED_DEVICES_DELAY_DEFAULT))
     parser.add_argument('-n', '--no-connected-device-delay', type=int,
                         help="Delay in seconds between each sync if there is" +
                         " no device connected. Defaults to {0} seconds."
                         .format(NO_CONNECTED_DEVICE_DELAY_DEFAULT))
-
-    args = parser.parse_args()
-    global verbose, connectedDevicesDelay, noConnectedDeviceDelay
-    if args.verbose is True:
+    parser.add_argument('-m', '--max-delay', type=int,
+                        help="Maximum delay in seconds between each sync" +
+                        " while nothing changes. The delay starts at the" +
+                        " connected devices delay and doubles on every" +
+                        " sync without changes. A clipboard copied on a" +
+                        " device may take that long to arrive, changes" +
+                        " on this computer are sent right away." +
+                        " Defaults to {0} seconds like the connected" +
+                        " devices delay."
+                        .format(MAX_DELAY_DEFAULT))
+    parser.add_argument('-d', '--debounce-ms', type=int,
+                        help="Time in milliseconds the clipboard of this" +
+                        " computer must stay unchanged before it is sent to" +
+                        " the devices. Defaults to {0} milliseconds."
+                        .format(DEBOUNCE_MS_DEFAULT))
+    parser.add_argument('-b', '--clipboard-backend',
+                        choices=CLIPBOARD_BACKENDS,
+                        help="How to access the clipboard of this computer." +
+                        " 'native' uses the tools of the platform," +
+                        " 'pyperclip' the pyperclip module and 'auto'" +
+                        " the native tools or pyperclip if they are" +
+                        " missing. Defaults to {0}."
+                        .format(CLIPBOARD_BACKEND_DEFAULT))
+
+    args = parser.parse_args(argv)
+    global verbose, connectedDevicesDelay, noConnectedDeviceDelay, maxDelay
+    global debounceMs, clipboardBackend
+    if args.verbose:
         verbose = True
     if args.connected_devices_delay is not None:
         connectedDevicesDelay = args.connected_devices_delay
     if args.no_connected_device_delay is not None:
-        noConnectedDeviceDelay = args.connected_devices_delay
-
-    if verbose is True:
+        noConnectedDeviceDelay = args.no_connected_device_delay
+    if args.max_delay is not None:
+        maxDelay = args.max_delay
+    if args.debounce_ms is not None:
+        debounceMs = args.debounce_ms
+    if args.clipboard_backend is not None:
+        clipboardBackend = args.clipboard_backend
+
+    if verbose:
         print("verbose: {0}".format(verbose))
         print("connectedDevicesDelay: {0}".format(connectedDevicesDelay))
         print("noConnectedDeviceDelay: {0}".format(noConnectedDeviceDelay))
-        print
+        print("maxDelay: {0}".format(maxDelay))
+        print("debounceMs: {0}".format(debounceMs))
+        print("clipboardBackend: {0}".format(clipboardBackend))
+        print()
+
+
+@functools.lru_cache(maxsize=None)
+def findExecutable(name):
+    # when not found, the name is used and starting it fails as before
+    return shutil.which(name) or name
+
+
+def startProcess(args, **kwargs):
+    # An absolute executable path and close_fds=False allow CPython to start
+    # the process with posix_spawn() instead of fork() and exec(), which
+    # does not need to copy the page tables of this process. Descriptors
+    # opened by Python are not inheritable (PEP 446), so none leak into
+    # the child.
+    return subprocess.Popen([findExecutable(args[0])] + list(args[1:]),
+                            close_fds=False, **kwargs)
 
 
 def checkAdbDependency():
-    try:
-        process = subprocess.Popen(['adb'], stdout=subprocess.PIPE)
-        return True
-    except OSError as e:
+    if shutil.which('adb') is None:
         print("adb not found. Please make sure Android SDK is installed" +
               " and adb is available on your PATH.")
-        if verbose is True:
-            print("error: {0}".format(e))
         return False
+    # start the adb server now so that tracking devices can connect to it
+    startProcess(['adb', 'start-server'], stdout=subprocess.DEVNULL).wait()
+    return True
 
 
-def getConnectedDeviceHashes():
-    adbProcess = subprocess.Popen(['adb', 'devices'], stdout=subprocess.PIPE)
-    adbDevicesOutput = adbProcess.communicate()[0]
-    adbDevicesOutputLines = adbDevicesOutput.splitlines()
-
-    # remove first line that contains a description
-    del adbDevicesOutputLines[0]
+async def getConnectedDeviceHashes():
+    if trackedDeviceHashes is not None:
+        return list(trackedDeviceHashes)
 
+    # see startProcess() for the arguments
+    adbProcess = await asyncio.create_subprocess_exec(
+        findExecutable('adb'), 'devices', stdout=subprocess.PIPE,
+        close_fds=False)
+    try:
+        adbDevicesOutput = (await asyncio.wait_for(
+            adbProcess.communicate(), ADB_DEVICES_TIMEOUT))[0]
+    except asyncio.TimeoutError:
+        print("adb devices did not answer within {0}s"
+              .format(ADB_DEVICES_TIMEOUT))
+        adbProcess.kill()
+        await adbProcess.wait()
+        return []
+    # skip first line that contains a description
+    return parseDeviceHashes(
+        adbDevicesOutput.decode('utf-8', 'replace').partition('\n')[2])
+
+
+def parseDeviceHashes(deviceList):
+    # one device per line, e.g. emulator-5554\tdevice. Devices in other
+    # states like offline or unauthorized cannot run commands.
     deviceHashes = []
-    for deviceLine in adbDevicesOutputLines:
-        if (len(deviceLine) > 0):
-            deviceHashes.append(deviceLine.split('\t')[0])
+    for deviceLine in deviceList.split('\n'):
+        deviceHash, _, state = deviceLine.partition('\t')
+        if len(deviceHash) > 0 and state.strip() == 'device':
+            deviceHashes.append(deviceHash)
     return deviceHashes
 
 
+async def readAdbServerMessage(reader):
+    # messages are prefixed with their length as 4 hex digits
+    length = int(await reader.readexactly(4), 16)
+    return (await reader.readexactly(length)).decode('utf-8', 'replace')
+
+
+class AdbServerRefusedError(IOError):
+    def __init__(self, request, message):
+        IOError.__init__(self, "adb server refused {0}: {1}".format(
+            request, message))
+        self.request = request
+
+
+async def connectToAdbServer(*requests):
+    # Speaks the adb server protocol directly instead of starting an adb
+    # client process. Each request is sent length-prefixed and must be
+    # acknowledged with OKAY before the next one is sent.
+    reader, writer = await asyncio.open_connection(
+        ADB_SERVER_HOST, ADB_SERVER_PORT, limit=ADB_STREAM_LIMIT)
+    try:
+        for request in requests:
+            writer.write("{0:04x}{1}".format(
+                len(request), request).encode('utf-8'))
+            await writer.drain()
+            status = await reader.readexactly(4)
+            if status != b"OKAY":
+                raise AdbServerRefusedError(
+                    request, await readAdbServerMessage(reader))
+    except BaseException:
+        writer.close()
+        raise
+    return reader, writer
+
+
+async def trackDevices():
+    # Keeps trackedDeviceHashes up to date with the device lists the adb
+    # server pushes on every change. While the server cannot be reached,
+    # getConnectedDeviceHashes() falls back to polling `adb devices`.
+    global trackedDeviceHashes
+    while True:
+        writer = None
+        try:
+            reader, writer = await connectToAdbServer("host:track-devices")
+            while True:
+                deviceList = await readAdbServerMessage(reader)
+                deviceHashes = parseDeviceHashes(deviceList)
+                if deviceHashes != trackedDeviceHashes:
+                    trackedDeviceHashes = deviceHashes
+                    syncRequested.set()
+                if verbose:
+                    print("tracked devices: {0}".format(trackedDeviceHashes))
+        except (IOError, OSError, ValueError,
+                asyncio.IncompleteReadError) as e:
+            if verbose:
+                print("tracking devices failed: {0}".format(e))
+        finally:
+            if writer is not None:
+                writer.close()
+        trackedDeviceHashes = None
+        await asyncio.sleep(ADB_TRACK_DEVICES_RETRY_DELAY)
+
+
+# Long-lived shell of one device. Commands are piped to its stdin to avoid
+# opening a new connection to the device for each command. The shell is
+# opened through the adb server directly with the raw exec service, which
+# does not allocate a pty that would echo the commands back.
+class PersistentAdbShell(object):
+    def __init__(self, deviceHash):
+        self.deviceHash = deviceHash
+        self.reader = None
+        self.writer = None
+        # False for devices before Android 5.0 that have no exec service
+        self.execSupported = True
+
+    def isAlive(self):
+        return self.writer is not None and not self.reader.at_eof()
+
+    async def open(self):
+        try:
+            self.reader, self.writer = await connectToAdbServer(
+                "host:transport:" + self.deviceHash, "exec:sh")
+        except AdbServerRefusedError as e:
+            if e.request != "exec:sh":
+                raise
+            if verbose:
+                print("{0} has no exec service, using a shell per command"
+                      .format(self.deviceHash))
+            self.execSupported = False
+
+    async def close(self):
+        if self.writer is not None:
+            self.writer.close()
+            self.reader = None
+            self.writer = None
+
+    async def execute(self, command):
+        try:
+            # a hanging device must not stall the sync of the other devices
+            return await asyncio.wait_for(self.sendCommand(command),
+                                          ADB_SHELL_TIMEOUT)
+        except (IOError, OSError, ValueError, asyncio.IncompleteReadError,
+                asyncio.LimitOverrunError, asyncio.TimeoutError) as e:
+            if verbose:
+                print("adb shell of {0} failed: {1!r}".format(
+                    self.deviceHash, e))
+            # the output of a command that was given up may still arrive
+            await self.close()
+            return None
+
+    async def sendCommand(self, command):
+        if self.execSupported and not self.isAlive():
+            await self.close()
+            await self.open()
+        if not self.execSupported:
+            return await self.runInNewShell(command)
+        endMarker = ADB_SHELL_END_MARKER + \
+            secrets.token_hex(8).encode('ascii') + b"_"
+        # the marker frames the output of the command in the stream,
+        # written separately to not copy large commands once more
+        self.writer.write(command)
+        self.writer.write(b" 2>&1; echo " + endMarker + b"$?\n")
+        await self.writer.drain()
+        # raises IncompleteReadError on EOF, e.g. because the device got
+        # disconnected. The shell is reopened on the next call.
+        output = await self.reader.readuntil(endMarker)
+        # only the exit code follows the marker
+        exitCode = await self.reader.readline()
+        if not exitCode.rstrip(b"\r\n").isdigit():
+            raise ValueError("unexpected output after the end marker: " +
+                             repr(exitCode))
+        return output[:-len(endMarker)]
+
+    async def runInNewShell(self, command):
+        # Like `adb shell <command>`, the shell ends with the command. Its
+        # output passes a pty that turns line ends into CRLF.
+        reader, writer = await connectToAdbServer(
+            "host:transport:" + self.deviceHash,
+            "shell:" + command.decode('ascii') + " 2>&1")
+        try:
+            output = await reader.read()
+        finally:
+            writer.close()
+        return output.replace(b"\r\n", b"\n")
+
+
+adbShells = {}
+
+
+def getAdbShell(deviceHash):
+    adbShell = adbShells.get(deviceHash)
+    if adbShell is None:
+        adbShell = PersistentAdbShell(deviceHash)
+        adbShells[deviceHash] = adbShell
+    return adbShell
+
+
+async def closeDisconnectedAdbShells(deviceHashes):
+    for deviceHash in list(adbShells.keys()):
+        if deviceHash not in deviceHashes:
+            await adbShells.pop(deviceHash).close()
+
+
+def shortenForOutput(clipboardString):
+    if clipboardString is not None and \
+            len(clipboardString) > PRINTED_CLIPBOARD_MAX_LENGTH:
+        return clipboardString[:PRINTED_CLIPBOARD_MAX_LENGTH] + "..."
+    return clipboardString
+
+
+def hashClipboard(clipboardString):
+    return hashClipboardBytes(clipboardString.encode('utf-8'))
+
+
+def hashClipboardBytes(clipboardBytes):
+    # a digest is compared in constant time and does not keep a possibly
+    # large clipboard in memory
+    return hashlib.blake2b(clipboardBytes, digest_size=16).digest()
+
+
 def urlEncode(unencodedString):
-    return urllib.quote_plus(unencodedString)
-
-
-def writeToDevice(deviceHash, urlEncodedString):
-    adbProcess = subprocess.Popen(
-        ['adb',
-            '-s', deviceHash,
-            'shell', 'am',
-            'broadcast',
-            '-n', 'ch.pete.adbclipboard/.WriteReceiver',
-            '-e', 'text', urlEncodedString],
-        stdout=subprocess.PIPE)
-    resultString = adbProcess.communicate()[0]
-    if verbose is True:
+    if NEEDS_URL_ENCODING_PATTERN.search(unencodedString) is None:
+        return unencodedString
+    # quote_plus() always leaves ~ as it is
+    return urllib.parse.quote_plus(unencodedString).replace('~', '%7E')
+
+
+def createWriteCommand(urlEncodedString):
+    # urlEncodedString only contains characters that are safe in the shell
+    return ADB_CLIPBOARD_WRITE_COMMAND + urlEncodedString.encode('ascii')
+
+
+async def writeToDevice(deviceHash, writeCommand):
+    # writeCommand is created once with createWriteCommand() and then sent
+    # to every device
+    resultString = await getAdbShell(deviceHash).execute(writeCommand)
+    if verbose and resultString is not None:
         print("write device response from {0}:\n{1}".format(
-            deviceHash, resultString))
+            deviceHash, resultString.decode('utf-8', 'replace')))
     return parseResponse(resultString)
 
 
-def readFromDevice(deviceHash):
-    adbProcess = subprocess.Popen(
-        ['adb',
-            '-s', deviceHash,
-            'shell', 'am',
-            'broadcast',
-            '-n', 'ch.pete.adbclipboard/.ReadReceiver'],
-        stdout=subprocess.PIPE)
-    resultString = adbProcess.communicate()[0]
-    if verbose is True:
+async def readFromDevice(deviceHash):
+    resultString = await getAdbShell(deviceHash).execute(
+        ADB_CLIPBOARD_READ_COMMAND)
+    if verbose and resultString is not None:
         print("read device response from {0}:\n{1}"
-              .format(deviceHash, resultString))
+              .format(deviceHash, resultString.decode('utf-8', 'replace')))
     return parseResponse(resultString)
 
 
 class Response(object):
-    status = None
-    data = None
+    # one is created per device and sync, slots avoid a __dict__ for each
+    __slots__ = ('status', 'data')
+
+    def __init__(self):
+        self.status = None
+        # UTF-8 encoded, only decoded when it is used as text
+        self.data = None
 
 
 def parseResponse(resultString):
-    resultMatcher = re.compile("^.*\n.*result=([\-]{0,1}[0-9]*).*")
-    resultMatch = resultMatcher.match(resultString)
     response = Response()
-    if resultMatch and resultMatch.groups > 0:
-        if len(resultMatch.group(1)) == 0:
-            print("error: " + resultMatch.group(1))
-        response.status = int(resultMatch.group(1))
+    if resultString is None:
+        # the adb shell failed
+        return response
+    # e.g. Broadcast completed: result=-1, data="clipboard text"
+    resultIndex = resultString.find(RESPONSE_RESULT_PREFIX)
+    if resultIndex >= 0:
+        statusStart = resultIndex + len(RESPONSE_RESULT_PREFIX)
+        statusEnd = statusStart
+        while statusEnd < len(resultString) and \
+                resultString[statusEnd] in b"-0123456789":
+            statusEnd += 1
+        try:
+            response.status = int(resultString[statusStart:statusEnd])
+        except ValueError:
+            print("error: invalid result in " +
+                  resultString.decode('utf-8', 'replace'))
+            return response
         if response.status == -1:
-            # re.DOTALL to match newline as well
-            dataMatcher = re.compile("^.*\n.*data=\"(.*)\"$", re.DOTALL)
-            dataMatch = dataMatcher.match(resultString)
-            if dataMatch and dataMatch.groups > 0:
-                response.data = dataMatch.group(1)
+            dataIndex = resultString.find(RESPONSE_DATA_PREFIX, statusEnd)
+            # the data itself may contain quotes, it ends at the last one
+            dataEnd = resultString.rfind(b"\"")
+            if dataIndex >= 0 and dataEnd >= dataIndex + len(
+                    RESPONSE_DATA_PREFIX):
+                response.data = resultString[
+                    dataIndex + len(RESPONSE_DATA_PREFIX):dataEnd]
     return response
 
 
-def syncWithDevices(clipboardHandler):
-    previousClipboardString = None
+# change token and text of the last read of the clipboard of this computer
+lastClipboardRead = (None, None)
+
+
+def readClipboard(clipboardHandler):
+    # Reading the clipboard may start a process, its change token is cheap.
+    # The token is taken before the read, so a change in between only
+    # causes another read next time.
+    global lastClipboardRead
+    changeToken = clipboardHandler.getChangeToken()
+    if changeToken is not None and changeToken == lastClipboardRead[0]:
+        return lastClipboardRead[1]
+    clipboardString = clipboardHandler.readClipboard()
+    lastClipboardRead = (changeToken, clipboardString)
+    return clipboardString
+
+
+def writeClipboard(clipboardHandler, text):
+    # The change token may only advance once the event loop handled the
+    # notification of this write, until then it would return the old text.
+    global lastClipboardRead
+    clipboardHandler.writeClipboard(text)
+    lastClipboardRead = (None, None)
+
+
+async def sleepUntilSyncRequested(delay):
+    try:
+        await asyncio.wait_for(syncRequested.wait(), delay)
+    except asyncio.TimeoutError:
+        pass
+    syncRequested.clear()
+
+
+async def pollClipboardChangeCount(getChangeCount, onChange):
+    # the change counters are read in-process, much cheaper than reading
+    # the clipboard itself
+    changeCount = getChangeCount()
     while True:
-        deviceHashes = getConnectedDeviceHashes()
+        await asyncio.sleep(CLIPBOARD_CHANGE_COUNT_POLL_INTERVAL)
+        newChangeCount = getChangeCount()
+        if newChangeCount != changeCount:
+            changeCount = newChangeCount
+            onChange()
+
+
+async def syncWithDevices(clipboardHandler):
+    global syncRequested
+    syncRequested = asyncio.Event()
+    # keep a reference, the event loop only holds weak references to tasks
+    trackDevicesTask = asyncio.create_task(trackDevices())
+    if not clipboardHandler.watchClipboard(syncRequested.set) and verbose:
+        print("clipboard changes are detected by polling only")
+    previousClipboardHash = None
+    # number of syncs in a row without any change
+    idleSyncs = 0
+    # device and hash of the last clipboard received from a device, that
+    # device does not need to receive it back
+    clipboardOwnerDeviceHash = None
+    clipboardOwnerHash = None
+    # hash and write command of the last clipboard sent to the devices,
+    # sending it again e.g. after no device had AdbClipboard reuses it
+    clipboardWriteCommand = (None, None)
+    # devices whose broadcasts were not received by AdbClipboard, they are
+    # left out until the devices change or noConnectedDeviceDelay passed
+    devicesWithoutAdbClipboard = set()
+    recheckDevicesTime = 0
+    previousDeviceHashes = None
+    while True:
+        deviceHashes = await getConnectedDeviceHashes()
+        await closeDisconnectedAdbShells(deviceHashes)
+        if deviceHashes != previousDeviceHashes or \
+                time.monotonic() >= recheckDevicesTime:
+            devicesWithoutAdbClipboard.clear()
+            recheckDevicesTime = time.monotonic() + noConnectedDeviceDelay
+        previousDeviceHashes = deviceHashes
 
         hasDeviceWithAdbClipboardInstalled = False
         hasUpdateFromDevice = False
@@ -144,51 +546,116 @@ def syncWithDevices(clipboardHandler):
             # no devices connected, sleep longer
             print("No device connected, sleep for {0}s"
                   .format(noConnectedDeviceDelay))
-            previousClipboardString = None
-            time.sleep(noConnectedDeviceDelay)
+            previousClipboardHash = None
+            idleSyncs = 0
+            await sleepUntilSyncRequested(noConnectedDeviceDelay)
         else:
-            clipboardString = clipboardHandler.readClipboard()
-            if previousClipboardString != clipboardString:
-                previousClipboardString = clipboardString
+            deviceHashes = [deviceHash for deviceHash in deviceHashes
+                            if deviceHash not in devicesWithoutAdbClipboard]
+            clipboardString = readClipboard(clipboardHandler)
+            clipboardHash = hashClipboard(clipboardString)
+            hasClipboardChanged = previousClipboardHash != clipboardHash
+            if hasClipboardChanged and debounceMs > 0 and \
+                    clipboardHash != clipboardOwnerHash:
+                # send changes in quick succession only once they settled
+                while True:
+                    await asyncio.sleep(debounceMs / 1000.0)
+                    stableClipboardString = readClipboard(clipboardHandler)
+                    stableClipboardHash = hashClipboard(stableClipboardString)
+                    if stableClipboardHash == clipboardHash:
+                        break
+                    clipboardString = stableClipboardString
+                    clipboardHash = stableClipboardHash
+            if hasClipboardChanged:
+                previousClipboardHash = clipboardHash
+
+                targetDeviceHashes = deviceHashes
+                if clipboardHash == clipboardOwnerHash and \
+                        clipboardOwnerDeviceHash in deviceHashes:
+                    targetDeviceHashes = [
+                        deviceHash for deviceHash in deviceHashes
+                        if deviceHash != clipboardOwnerDeviceHash]
+                    hasDeviceWithAdbClipboardInstalled = True
+                clipboardOwnerDeviceHash = None
+                clipboardOwnerHash = None
 
                 if len(clipboardString) > 0:
-                    urlEncodedString = urlEncode(clipboardString)
-                    for deviceHash in deviceHashes:
-                        response = writeToDevice(
-                            deviceHash, urlEncodedString)
+                    if clipboardWriteCommand[0] != clipboardHash:
+                        clipboardWriteCommand = (
+                            clipboardHash,
+                            createWriteCommand(urlEncode(clipboardString)))
+                    writeCommand = clipboardWriteCommand[1]
+                    # devices are independent, talk to all of them at once
+                    responses = await asyncio.gather(
+                        *(writeToDevice(deviceHash, writeCommand)
+                          for deviceHash in targetDeviceHashes))
+                    printedClipboardString = shortenForOutput(clipboardString)
+                    for deviceHash, response in zip(targetDeviceHashes,
+                                                    responses):
                         printedStatus = ""
-                        if response.status is -1:
+                        if response.status == -1:
                             hasDeviceWithAdbClipboardInstalled = True
                         else:
                             printedStatus = " (failed)"
+                            if response.status == \
+                                    RESPONSE_STATUS_NOT_RECEIVED:
+                                devicesWithoutAdbClipboard.add(deviceHash)
                         print("send to {0}: \"{1}\"{2}".format(
-                            deviceHash, clipboardString, printedStatus))
+                            deviceHash, printedClipboardString,
+                            printedStatus))
             else:
-                for deviceHash in deviceHashes:
-                    response = readFromDevice(deviceHash)
+                responses = await asyncio.gather(
+                    *(readFromDevice(deviceHash)
+                      for deviceHash in deviceHashes))
+                for deviceHash, response in zip(deviceHashes, responses):
+                    if response.status == RESPONSE_STATUS_NOT_RECEIVED:
+                        devicesWithoutAdbClipboard.add(deviceHash)
                     if response.status == -1:
                         hasDeviceWithAdbClipboardInstalled = True
-                        deviceClipboardText = response.data
-
-                        if len(clipboardString) == 0 or \
-                                deviceClipboardText != clipboardString:
+                        if response.data is None:
+                            continue
+                        # compare encoded, an unchanged clipboard of the
+                        # device is never decoded
+                        deviceClipboardHash = hashClipboardBytes(
+                            response.data)
+                        if deviceClipboardHash != clipboardHash:
+                            deviceClipboardText = response.data.decode(
+                                'utf-8', 'replace')
                             print("recv from {0}: \"{1}\"".format(
-                                deviceHash, deviceClipboardText))
-                            if deviceClipboardText is not None:
-                                if verbose is True:
-                                    print("write to clipboard: {0}".format(
-                                        deviceClipboardText))
-                                clipboardHandler.writeClipboard(
-                                    deviceClipboardText)
-                                hasUpdateFromDevice = True
-                                break
-            if hasDeviceWithAdbClipboardInstalled is False:
+                                deviceHash,
+                                shortenForOutput(deviceClipboardText)))
+                            if verbose:
+                                print("write to clipboard: {0}".format(
+                                    deviceClipboardText))
+                            writeClipboard(clipboardHandler,
+                                           deviceClipboardText)
+                            clipboardOwnerDeviceHash = deviceHash
+                            clipboardOwnerHash = deviceClipboardHash
+                            hasUpdateFromDevice = True
+                            break
+            if not hasDeviceWithAdbClipboardInstalled:
                 print("No device with installed AdbClipboard, sleep for {0}s"
                       .format(noConnectedDeviceDelay))
-                previousClipboardString = None
-                time.sleep(noConnectedDeviceDelay)
-            elif hasUpdateFromDevice is False:
-                time.sleep(connectedDevicesDelay)
+                previousClipboardHash = None
+                idleSyncs = 0
+                devicesWithoutAdbClipboard.clear()
+                await sleepUntilSyncRequested(noConnectedDeviceDelay)
+            elif hasClipboardChanged:
+                idleSyncs = 0
+                await sleepUntilSyncRequested(connectedDevicesDelay)
+            elif not hasUpdateFromDevice:
+                # nothing changed, back off exponentially up to maxDelay but
+                # never sync more often than every connectedDevicesDelay
+                delayLimit = max(maxDelay, connectedDevicesDelay)
+                delay = min(connectedDevicesDelay * 2 ** idleSyncs,
+                            delayLimit)
+                if delay < delayLimit:
+                    idleSyncs += 1
+                if verbose:
+                    print("no changes, sleep for {0}s".format(delay))
+                await sleepUntilSyncRequested(delay)
+            else:
+                idleSyncs = 0
 
 
 class ClipboardHandlerMac(object):
@@ -196,49 +663,344 @@ class ClipboardHandlerMac(object):
         # on Mac pbpaste is preinstalled
         return True
 
+    def watchClipboard(self, onChange):
+        # needs pyobjc for the change counter of the pasteboard
+        if NSPasteboard is None:
+            return False
+        pasteboard = NSPasteboard.generalPasteboard()
+        self.watchTask = asyncio.create_task(pollClipboardChangeCount(
+            pasteboard.changeCount, onChange))
+        return True
+
+    def getChangeToken(self):
+        if NSPasteboard is None:
+            return None
+        return NSPasteboard.generalPasteboard().changeCount()
+
     def readClipboard(self):
-        process = subprocess.Popen(['pbpaste'], stdout=subprocess.PIPE)
-        clipboardText = process.communicate()[0]
+        process = startProcess(['pbpaste'],
+                               stdin=subprocess.DEVNULL,
+                               stdout=subprocess.PIPE)
+        clipboardText = process.communicate()[0].decode('utf-8', 'replace')
         return clipboardText
 
     def writeClipboard(self, text):
-        process = subprocess.Popen(['pbcopy'],
-                                   stdin=subprocess.PIPE,
-                                   stdout=subprocess.PIPE)
-        process.communicate(input=text)
+        process = startProcess(['pbcopy'],
+                               stdin=subprocess.PIPE,
+                               stdout=subprocess.DEVNULL)
+        process.communicate(input=text.encode('utf-8'))
 
 
 class ClipboardHandlerLinux(object):
+    def __init__(self):
+        self.display = None
+        # number of clipboard owner changes while watching, None otherwise
+        self.ownerChangeCount = None
+        # window that receives the clipboard when reading it with Xlib,
+        # False when xclip is used instead
+        self.selectionWindow = None
+
     def checkDependencies(self):
-        try:
-            process = subprocess.Popen(['xclip'], stdout=subprocess.PIPE)
-            return True
-        except OSError as e:
+        if shutil.which('xclip') is None:
             print("xclip not found." +
                   " Please install it with your package manager.")
             print("e.g. sudo apt install xclip")
-            if verbose is True:
-                print("error: {0}".format(e))
             return False
+        return True
+
+    def watchClipboard(self, onChange):
+        # needs python-xlib to be notified when the clipboard owner changes
+        if xdisplay is None:
+            return False
+        try:
+            self.display = xdisplay.Display()
+            if not self.display.has_extension('XFIXES'):
+                return False
+            self.display.xfixes_query_version()
+            self.display.xfixes_select_selection_input(
+                self.display.screen().root,
+                self.display.get_atom('CLIPBOARD'),
+                xfixes.XFixesSetSelectionOwnerNotifyMask)
+            self.display.flush()
+        except Exception as e:
+            if verbose:
+                print("cannot watch the X clipboard: {0}".format(e))
+            return False
+
+        def onDisplayReadable():
+            while self.display.pending_events():
+                event = self.display.next_event()
+                if (event.type, event.sub_code) == \
+                        self.display.extension_event.SetSelectionOwnerNotify:
+                    self.ownerChangeCount += 1
+                    onChange()
+        self.ownerChangeCount = 0
+        asyncio.get_event_loop().add_reader(
+            self.display.fileno(), onDisplayReadable)
+        return True
+
+    def getChangeToken(self):
+        # every copy sets a new owner of the clipboard selection
+        return self.ownerChangeCount
+
+    def openSelectionWindow(self):
+        # a connection of its own, the events of self.display are handled
+        # by the event loop
+        try:
+            self.selectionDisplay = xdisplay.Display()
+            self.selectionWindow = \
+                self.selectionDisplay.screen().root.create_window(
+                    0, 0, 1, 1, 0, X.CopyFromParent)
+            self.clipboardAtom = self.selectionDisplay.get_atom('CLIPBOARD')
+            self.utf8StringAtom = self.selectionDisplay.get_atom(
+                'UTF8_STRING')
+            self.incrAtom = self.selectionDisplay.get_atom('INCR')
+            self.selectionPropertyAtom = self.selectionDisplay.get_atom(
+                'ADBCLIPBOARD_SELECTION')
+        except Exception as e:
+            if verbose:
+                print("cannot read the X clipboard directly: {0}".format(e))
+            self.selectionWindow = False
+
+    def readClipboardWithXlib(self):
+        # Asks the owner of the clipboard to store it as UTF-8 in a property
+        # of selectionWindow. Returns None if xclip has to read it instead,
+        # e.g. when a large clipboard is transferred incrementally.
+        display = self.selectionDisplay
+        if display.get_selection_owner(self.clipboardAtom) == X.NONE:
+            return ''
+        self.selectionWindow.convert_selection(
+            self.clipboardAtom, self.utf8StringAtom,
+            self.selectionPropertyAtom, X.CurrentTime)
+        display.flush()
+        deadline = time.monotonic() + X_SELECTION_TIMEOUT
+        while True:
+            while display.pending_events() == 0:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0 or \
+                        not select.select([display], [], [], remaining)[0]:
+                    return None
+            event = display.next_event()
+            if event.type == X.SelectionNotify and \
+                    event.selection == self.clipboardAtom:
+                break
+        if event.property == X.NONE:
+            # the owner cannot provide the clipboard as UTF-8
+            return None
+        clipboardProperty = self.selectionWindow.get_full_property(
+            self.selectionPropertyAtom, X.AnyPropertyType)
+        if clipboardProperty is None or \
+                clipboardProperty.property_type == self.incrAtom:
+            # deleting an INCR property would start the incremental transfer
+            return None
+        self.selectionWindow.delete_property(self.selectionPropertyAtom)
+        if clipboardProperty.format != 8:
+            return None
+        # an invalid clipboard of one application must not disable Xlib
+        return clipboardProperty.value.decode('utf-8', 'replace')
 
     def readClipboard(self):
-        process = subprocess.Popen(['xclip'], stdout=subprocess.PIPE)
-        clipboardText = process.communicate()[0]
+        if xdisplay is not None and self.selectionWindow is None:
+            self.openSelectionWindow()
+        if self.selectionWindow:
+            try:
+                clipboardText = self.readClipboardWithXlib()
+                if clipboardText is not None:
+                    return clipboardText
+            except Exception as e:
+                if verbose:
+                    print("reading the X clipboard failed: {0}".format(e))
+                self.selectionWindow = False
+        # xclip -o fails with a message on stderr when the clipboard is empty
+        process = startProcess(['xclip', '-selection', 'clipboard', '-o'],
+                               stdin=subprocess.DEVNULL,
+                               stdout=subprocess.PIPE,
+                               stderr=subprocess.DEVNULL)
+        clipboardText = process.communicate()[0].decode('utf-8', 'replace')
         return clipboardText
 
     def writeClipboard(self, text):
-        process = subprocess.Popen(['xclip', '-o'],
-                                   stdin=subprocess.PIPE,
-                                   stdout=subprocess.PIPE)
-        process.communicate(input=text)
+        process = startProcess(['xclip', '-selection', 'clipboard'],
+                               stdin=subprocess.PIPE,
+                               stdout=subprocess.DEVNULL,
+                               stderr=subprocess.DEVNULL)
+        process.communicate(input=text.encode('utf-8'))
+
+
+# Uses the Win32 clipboard API in-process. Falls back to PowerShell when the
+# clipboard cannot be opened, e.g. because another application holds it.
+class ClipboardHandlerWindows(object):
+    CF_UNICODETEXT = 13
+    GMEM_MOVEABLE = 0x0002
+    OPEN_CLIPBOARD_ATTEMPTS = 5
+    OPEN_CLIPBOARD_RETRY_DELAY = 0.01
+
+    def __init__(self):
+        from ctypes import wintypes
+        self.user32 = ctypes.WinDLL('user32', use_last_error=True)
+        self.kernel32 = ctypes.WinDLL('kernel32', use_last_error=True)
+        self.user32.OpenClipboard.argtypes = [wintypes.HWND]
+        self.user32.OpenClipboard.restype = wintypes.BOOL
+        self.user32.CloseClipboard.restype = wintypes.BOOL
+        self.user32.EmptyClipboard.restype = wintypes.BOOL
+        self.user32.GetClipboardData.argtypes = [wintypes.UINT]
+        self.user32.GetClipboardData.restype = wintypes.HANDLE
+        self.user32.SetClipboardData.argtypes = [
+            wintypes.UINT, wintypes.HANDLE]
+        self.user32.SetClipboardData.restype = wintypes.HANDLE
+        self.kernel32.GlobalAlloc.argtypes = [wintypes.UINT, ctypes.c_size_t]
+        self.kernel32.GlobalAlloc.restype = wintypes.HGLOBAL
+        self.kernel32.GlobalLock.argtypes = [wintypes.HGLOBAL]
+        self.kernel32.GlobalLock.restype = wintypes.LPVOID
+        self.kernel32.GlobalUnlock.argtypes = [wintypes.HGLOBAL]
+        self.kernel32.GlobalUnlock.restype = wintypes.BOOL
+        self.kernel32.GlobalFree.argtypes = [wintypes.HGLOBAL]
+        self.kernel32.GlobalFree.restype = wintypes.HGLOBAL
+        self.user32.GetClipboardSequenceNumber.restype = wintypes.DWORD
 
+    def checkDependencies(self):
+        # the clipboard API is part of every Windows installation
+        return True
 
-if platform.system() == "Linux":
-    clipboardHandler = ClipboardHandlerLinux()
-else:
-    clipboardHandler = ClipboardHandlerMac()
+    def watchClipboard(self, onChange):
+        self.watchTask = asyncio.create_task(pollClipboardChangeCount(
+            self.user32.GetClipboardSequenceNumber, onChange))
+        return True
 
-parseArgs()
-if checkAdbDependency() is True:
-    if clipboardHandler.checkDependencies() is True:
-        syncWithDevices(clipboardHandler)
+    def getChangeToken(self):
+        # 0 when the sequence number is not accessible
+        return self.user32.GetClipboardSequenceNumber() or None
+
+    @contextlib.contextmanager
+    def openClipboard(self):
+        attempt = 1
+        while not self.user32.OpenClipboard(None):
+            if attempt >= self.OPEN_CLIPBOARD_ATTEMPTS:
+                raise ctypes.WinError(ctypes.get_last_error())
+            attempt += 1
+            time.sleep(self.OPEN_CLIPBOARD_RETRY_DELAY)
+        try:
+            yield
+        finally:
+            self.user32.CloseClipboard()
+
+    def readClipboard(self):
+        try:
+            with self.openClipboard():
+                handle = self.user32.GetClipboardData(self.CF_UNICODETEXT)
+                if not handle:
+                    return ""
+                pointer = self.kernel32.GlobalLock(handle)
+                try:
+                    return ctypes.wstring_at(pointer)
+                finally:
+                    self.kernel32.GlobalUnlock(handle)
+        except OSError as e:
+            if verbose:
+                print("clipboard API failed, use PowerShell: {0}".format(e))
+            return self.readClipboardWithPowerShell()
+
+    def writeClipboard(self, text):
+        try:
+            buffer = ctypes.create_unicode_buffer(text)
+            handle = self.kernel32.GlobalAlloc(
+                self.GMEM_MOVEABLE, ctypes.sizeof(buffer))
+            if not handle:
+                raise ctypes.WinError(ctypes.get_last_error())
+            pointer = self.kernel32.GlobalLock(handle)
+            ctypes.memmove(pointer, buffer, ctypes.sizeof(buffer))
+            self.kernel32.GlobalUnlock(handle)
+            try:
+                with self.openClipboard():
+                    self.user32.EmptyClipboard()
+                    if not self.user32.SetClipboardData(
+                            self.CF_UNICODETEXT, handle):
+                        raise ctypes.WinError(ctypes.get_last_error())
+            except OSError:
+                # the clipboard only takes ownership of the memory on success
+                self.kernel32.GlobalFree(handle)
+                raise
+        except OSError as e:
+            if verbose:
+                print("clipboard API failed, use PowerShell: {0}".format(e))
+            self.writeClipboardWithPowerShell(text)
+
+    def readClipboardWithPowerShell(self):
+        process = startProcess(
+            ['powershell', '-NoProfile', '-Command',
+             '[Console]::OutputEncoding = [Text.Encoding]::UTF8;' +
+             ' Get-Clipboard -Raw'],
+            stdout=subprocess.PIPE)
+        clipboardText = process.communicate()[0].decode('utf-8', 'replace')
+        # PowerShell terminates its output with a newline
+        if clipboardText.endswith('\r\n'):
+            clipboardText = clipboardText[:-2]
+        return clipboardText
+
+    def writeClipboardWithPowerShell(self, text):
+        process = startProcess(
+            ['powershell', '-NoProfile', '-Command',
+             '[Console]::InputEncoding = [Text.Encoding]::UTF8;' +
+             ' Set-Clipboard -Value ([Console]::In.ReadToEnd())'],
+            stdin=subprocess.PIPE,
+            stdout=subprocess.DEVNULL)
+        process.communicate(input=text.encode('utf-8'))
+
+
+# Accesses the clipboard in-process through pyperclip where it supports it
+class ClipboardHandlerPyperclip(object):
+    def checkDependencies(self):
+        if pyperclip is None:
+            print("pyperclip not found. Please install it with pip.")
+            print("e.g. pip3 install pyperclip")
+            return False
+        try:
+            pyperclip.paste()
+            return True
+        except pyperclip.PyperclipException as e:
+            print("pyperclip cannot access the clipboard.")
+            if verbose:
+                print("error: {0}".format(e))
+            return False
+
+    def watchClipboard(self, onChange):
+        # pyperclip offers no way to detect changes
+        return False
+
+    def getChangeToken(self):
+        return None
+
+    def readClipboard(self):
+        return pyperclip.paste()
+
+    def writeClipboard(self, text):
+        pyperclip.copy(text)
+
+
+def createClipboardHandler():
+    # The native handlers are preferred, they detect clipboard changes
+    # without starting processes. The Linux one is the only one that
+    # depends on a tool, pyperclip may find another one like xsel.
+    if clipboardBackend == 'pyperclip' or \
+            (clipboardBackend == 'auto' and pyperclip is not None and
+             platform.system() == "Linux" and shutil.which('xclip') is None):
+        return ClipboardHandlerPyperclip()
+    elif platform.system() == "Linux":
+        return ClipboardHandlerLinux()
+    elif platform.system() == "Windows":
+        return ClipboardHandlerWindows()
+    else:
+        return ClipboardHandlerMac()
+
+
+if __name__ == '__main__':
+    if platform.system() == "Windows":
+        # only the proactor event loop can run subprocesses on Windows, it
+        # is the default from Python 3.8 on
+        asyncio.set_event_loop_policy(
+            asyncio.WindowsProactorEventLoopPolicy())
+    parseArgs()
+    clipboardHandler = createClipboardHandler()
+    if checkAdbDependency():
+        if clipboardHandler.checkDependencies():
+            asyncio.run(syncWithDevices(clipboardHandler))